@@ -1,24 +1,70 @@
-def bruteforce_search(string: str):
-    length = len(string)
-    begin_index = 0
-    while begin_index < length:
-        end_index = begin_index + 1
-        while end_index <= length:
-            substr = string[begin_index:end_index]
-            if is_periodic(substr, string[end_index:]):
-                return string[:begin_index], substr, begin_index
-            end_index += 1
-        begin_index += 1
-    return string, '', -1
-
-
-def is_periodic(substr: str, rem: str):
-    k = len(substr)
-    r = len(rem)
-    if k == 0 or r == 0 or r < k:
-        return False
-
-    for i in range(r):
-        if rem[i] != substr[i % k]:
-            return False
-    return True
+import numpy as np
+from numba import njit, prange
+
+
+@njit(nogil=True, cache=True)
+def find_cycle(seq: np.ndarray):
+    """
+    Finds the eventually periodic decomposition prefix + cycle^k of an itinerary in O(n).
+
+    The suffix of length L, reversed, is the prefix of length L of the reversed itinerary, and a
+    sequence and its reversal have the same periods. So with the KMP failure function pi of the
+    reversed itinerary, L - pi[L - 1] is the smallest period of every suffix, all from one pass.
+    The first suffix that repeats its smallest period at least twice determines the decomposition.
+
+    :param seq: the itinerary as a 1D integer array of branch orders
+    :return: the index at which the cycle begins and the length of the cycle ((-1, 0) if no cycle)
+    """
+    length = seq.size
+    pi = failure_function(seq[::-1])
+    for begin_index in range(length):
+        suffix_len = length - begin_index
+        period = suffix_len - pi[suffix_len - 1]
+        if 2 * period <= suffix_len:
+            return begin_index, period
+    return -1, 0
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def find_cycles(seqs: np.ndarray):
+    """
+    Finds the eventually periodic decomposition of every itinerary in parallel.
+
+    Like tree_numba.simulate, this needs Numba's TBB or OpenMP threading layer to be called from several
+    threads at once; use find_cycles_serial to split the work yourself.
+
+    :param seqs: the itineraries as columns of a 2D integer array of shape (n_iter, n_starts)
+    :return: the indices at which the cycles begin and the lengths of the cycles (see find_cycle)
+    """
+    n_starts = seqs.shape[1]
+    indices = np.empty(n_starts, dtype=np.int64)
+    periods = np.empty(n_starts, dtype=np.int64)
+    for j in prange(n_starts):
+        indices[j], periods[j] = find_cycle(seqs[:, j])
+    return indices, periods
+
+
+@njit(nogil=True, cache=True)
+def find_cycles_serial(seqs: np.ndarray):
+    """
+    Finds the decomposition of every itinerary like find_cycles, but on the calling thread only.
+    """
+    n_starts = seqs.shape[1]
+    indices = np.empty(n_starts, dtype=np.int64)
+    periods = np.empty(n_starts, dtype=np.int64)
+    for j in range(n_starts):
+        indices[j], periods[j] = find_cycle(seqs[:, j])
+    return indices, periods
+
+
+@njit(nogil=True, cache=True)
+def failure_function(seq: np.ndarray):
+    pi = np.zeros(seq.size, dtype=np.int64)
+    k = 0
+    for i in range(1, seq.size):
+        while k > 0 and seq[i] != seq[k]:
+            k = pi[k - 1]
+        if seq[i] == seq[k]:
+            k += 1
+        pi[i] = k
+    return pi
@@ -1,12 +1,19 @@
 import numpy as np
-from algo import bruteforce_search
+from algo import find_cycles
 from tree import Interval, Linear, PiecewiseLinear, Branch, Tree, Plotter
 
 
-def parse_itinerary(itinerary: list[Branch]):
-    x_values = np.arange(1, len(itinerary) + 1, 1)
-    y_labels = [b.label() for b in itinerary]
-    return x_values, y_labels
+def label_table(labels: dict[int, str]):
+    # maps each branch order, as a byte, to its label; None unless every label is a single ASCII character
+    if not all(len(label) == 1 and label.isascii() for label in labels.values()):
+        return None
+    return bytes.maketrans(bytes(labels), ''.join(labels.values()).encode())
+
+
+def parse_itinerary(itinerary: np.ndarray, labels: dict[int, str], table: bytes | None):
+    if table is None:
+        return [labels[k] for k in itinerary.tolist()]
+    return itinerary.astype(np.uint8).tobytes().translate(table).decode()
 
 
 ##############################
@@ -46,22 +53,25 @@ def run_batch(start: float, stop: float, step: float, plot=False, n_iter=200):
 
     t = Tree(f, [branch_a, branch_b, branch_c1, branch_c2])
 
-    n_aperiodic = 0  # number of aperiodic itineraries
-    aperiodic_pts = []  # the starting points of the aperiodic itinerary
-
-    for s in np.arange(start, stop, step):
-        t.iter(s, n_iter)
-        x_values, y_labels = parse_itinerary(t.itinerary())
-        prefix, cycle, index = bruteforce_search(''.join(y_labels))
+    starts = np.arange(start, stop, step)
+    values, orders = t.iter_batch(starts, n_iter)
+    indices, periods = find_cycles(orders)
+    x_values = np.arange(1, n_iter + 1, 1) if plot else None  # the steps, only needed for plotting
+    labels = t.labels_by_order()
+    table = label_table(labels)
+
+    for j, s in enumerate(starts):
+        index, period = indices[j], periods[j]
+        itinerary = parse_itinerary(orders[:, j], labels, table)  # a string, or a list of labels
+        prefix = ''.join(itinerary[:index] if index >= 0 else itinerary)
+        cycle = ''.join(itinerary[index:index + period])
         print(f'Itinerary from {format(s, ".1f")}: at {index} ({prefix}, {cycle})')
-        if len(cycle) == 0:
-            n_aperiodic += 1
-            aperiodic_pts.append(s)
         if plot:
-            Plotter.plot(x_values, t.values(), y_labels, s, (index, len(cycle)), t.orders(), t.labels())
+            Plotter.plot(x_values, values[:, j], list(itinerary), s, (index, period), t.orders(), t.labels())
 
-    print(f'Number of aperiodic itineraries: {n_aperiodic}')
-    print(f'Aperiodic starting points: {aperiodic_pts}')
+    aperiodic_pts = starts[periods == 0]  # the starting points of the aperiodic itineraries
+    print(f'Number of aperiodic itineraries: {aperiodic_pts.size}')
+    print(f'Aperiodic starting points: {aperiodic_pts.tolist()}')
 ##############################
 
 
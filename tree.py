@@ -1,12 +1,26 @@
 from __future__ import annotations
+import bisect
 import numpy as np
-import matplotlib.pyplot as plt
+from tree_numba import simulate, simulate_serial, specialize
 
 
 def mutually_disjoint(intervals: list[Interval]):
-    new_intervals = sorted(intervals, key=lambda x: x[0])
-    for i in range(len(new_intervals) - 1):
-        if new_intervals[i].overlaps(new_intervals[i + 1]):
+    # once sorted, an interval can only overlap its predecessor by starting at or before its end
+    prev = None
+    for cur in sorted(intervals, key=lambda x: (x[0], x[1])):
+        if prev is not None and (cur[0] < prev[1] or
+                                 (cur[0] == prev[1] and cur.l_inclusive() and prev.r_inclusive())):
+            return False
+        prev = cur
+    return True
+
+
+def half_open_contiguous(intervals: list[Interval]):
+    # True if the sorted intervals are all of the form [lo, hi) and each starts where the previous one stops
+    for i, cur in enumerate(intervals):
+        if not cur.l_inclusive() or cur.r_inclusive():
+            return False
+        if i > 0 and cur[0] != intervals[i - 1][1]:
             return False
     return True
 
@@ -22,6 +36,8 @@ class Interval:
     [0, inf) <=> Interval(0, np.inf) <=> Interval(0, np.infty)
     3 <=> Interval(3, 3, incl_r=True)
     """
+    __slots__ = ('_lo', '_hi', '_l', '_r')
+
     def __init__(self, start: float, stop: float, incl_l: bool = True, incl_r: bool = False):
         """
         Creates a real-valued interval.
@@ -40,7 +56,8 @@ class Interval:
         if (start == np.infty and incl_l) or (stop == np.infty and incl_r):
             raise ValueError("Infinity cannot be included")
 
-        self._int = [start, stop]
+        self._lo = start
+        self._hi = stop
         self._l = incl_l
         self._r = incl_r
 
@@ -51,25 +68,30 @@ class Interval:
         return self._r
 
     def overlaps(self, other: Interval):
-        if other[1] < self[0] or self[1] < other[0]:
-            return False
-        if other[1] == self[0] and not (other._r and self._l):
-            return False
-        if self[1] == other[0] and not (self._r and other._l):
-            return False
-        return True
+        """
+        Checks whether this interval shares a point with another one.
+
+        This is the general case, meant for validating definitions; use `x in interval` for points.
+        """
+        return not (other._hi < self._lo or self._hi < other._lo or
+                    (other._hi == self._lo and not (other._r and self._l)) or
+                    (self._hi == other._lo and not (self._r and other._l)))
 
     def __contains__(self, x: float):
-        return self.overlaps(Interval(x, x, incl_r=True))
+        return (self._lo <= x if self._l else self._lo < x) and (x <= self._hi if self._r else x < self._hi)
 
     def __eq__(self, other: Interval):
-        return self[0] == other[0] and self[1] == other[1] and self._l == other._l and self._r == other._r
+        return self._lo == other._lo and self._hi == other._hi and self._l == other._l and self._r == other._r
 
     def __len__(self):
-        return self._int[1] - self._int[0]
+        return self._hi - self._lo
 
     def __getitem__(self, item):
-        return self._int[item]
+        if item == 0:
+            return self._lo
+        if item == 1:
+            return self._hi
+        return (self._lo, self._hi)[item]
 
     def __repr__(self):
         return str(self)
@@ -77,7 +99,7 @@ class Interval:
     def __str__(self):
         left = '[' if self._l else '('
         right = ']' if self._r else ')'
-        return f'{left}{self._int[0]}, {self._int[1]}{right}'
+        return f'{left}{self._lo}, {self._hi}{right}'
 
 
 class Linear:
@@ -89,6 +111,8 @@ class Linear:
     f(x) = 3x + 3 on R <=> Linear(3, 3, Interval(-np.inf, np.inf, incl_l=False))
     f(x) = -x + 1 on [0, 1] <=> Linear(0, 1, Interval(0, 1, incl_r=True))
     """
+    __slots__ = ('_a', '_b', '_d')
+
     def __init__(self, slope: float, intercept: float, domain: Interval):
         if slope is None:
             raise ValueError('Slope must not be None')
@@ -115,6 +139,10 @@ class Linear:
             raise ValueError(f'Value {x} is not in the domain {self._d}')
         return self._a * x + self._b
 
+    def _fast(self, x: float) -> float:
+        # evaluates without the domain check, for callers that already located the piece
+        return self._a * x + self._b
+
     def __str__(self):
         return f'f(x) = {self._a}x+{self._b} for x in {self._d}'
 
@@ -132,22 +160,30 @@ class PiecewiseLinear:
     f2 = Linear(3, 5, Interval(0, np.inf))
     pl = PiecewiseLinear([f1, f2])
     """
+    __slots__ = ('_funcs', '_num_funcs', '_bounds', '_slopes', '_intercepts')
+
     def __init__(self, funcs: list[Linear]):
         if funcs is None:
             raise ValueError('Function definitions must not be None')
+        if len(funcs) == 0:
+            raise ValueError('Function definitions must not be empty')
         if not mutually_disjoint([f.domain() for f in funcs]):
             raise ValueError('Function domains must be mutually disjoint')
 
         self._funcs = sorted(funcs, key=lambda x: x.domain()[0])
         self._num_funcs = len(funcs)
+        self._bounds = np.array([f.domain()[0] for f in self._funcs] + [self._funcs[-1].domain()[1]], dtype=float)
+        self._slopes = np.array([f.slope() for f in self._funcs], dtype=float)
+        self._intercepts = np.array([f.intercept() for f in self._funcs], dtype=float)
 
     def __len__(self):
         return self._num_funcs
 
     def __call__(self, x: float):
-        for f in self._funcs:
-            if x in f.domain():
-                return f(x)
+        k = int(np.searchsorted(self._bounds, x, side='right')) - 1
+        for i in (k, k - 1):  # x may sit on the excluded left bound of piece k
+            if 0 <= i < self._num_funcs and x in self._funcs[i].domain():
+                return self._funcs[i]._fast(x)
         raise ValueError(f'Value {x} does not lie any defined domain')
 
     def __repr__(self):
@@ -167,6 +203,8 @@ class Branch:
     ----------
     A branch labelled 'a' with domain [0, 1] <=> Branch('a', Interval(0, 1, incl_r=True))
     """
+    __slots__ = ('_label', '_domain', '_order')
+
     def __init__(self, label: str, domain: Interval, order: int):
         if label is None or domain is None or order is None:
             raise ValueError('Branch parameters must not be None')
@@ -203,33 +241,122 @@ class Tree:
 
     This tree has one fixed point that joins an arbitrary number of branches.
     """
-    def __init__(self, f: PiecewiseLinear, bs: list[Branch]):
+    __slots__ = ('_f', '_bs', '_num_branches', '_values', '_itinerary', '_meta',
+                 '_sorted_bs', '_lows', '_edges', '_orders', '_by_order', '_labels_by_order', '_contiguous',
+                 '_kernel')
+
+    def __init__(self, f: PiecewiseLinear, bs: list[Branch], specialized: bool = False):
+        """
+        Creates a tree.
+
+        :param f: the piecewise linear map on the tree
+        :param bs: the branches of the tree
+        :param specialized: True if the simulation kernel should be generated for this very tree, which pays off
+            for long runs only as it is compiled anew in every process; False, otherwise (False by default)
+        """
         if f is None or bs is None:
             raise ValueError('Tree parameters must not be None')
+        if len(bs) == 0:
+            raise ValueError('Branch definitions must not be empty')
+        if any(not 0 <= b.order() <= 127 for b in bs):
+            raise ValueError('Branch orders must be between 0 and 127')  # stored as int8
         # if len(f) != len(bs):  # TODO: Not necessarily have to equal
         #     raise ValueError('The number of functions does not match the number of branches')
 
         self._f = f
         self._bs = bs
         self._num_branches = len(bs)
-        self._values = []
-        self._itinerary = []
+        self._values = np.empty(0)
+        self._itinerary = np.empty(0, dtype=np.int8)
         self._meta = sorted([(b.label(), b.order()) for b in bs])
 
-    def iter(self, start: float, num_it: int):
-        self._values = []
-        self._itinerary = []
+        # branches sorted by their lower bounds
+        self._sorted_bs = sorted(bs, key=lambda b: b.domain()[0])
+        self._lows = [b.domain()[0] for b in self._sorted_bs]
+        self._edges = np.array(self._lows + [self._sorted_bs[-1].domain()[1]], dtype=float)
+        self._orders = np.array([b.order() for b in self._sorted_bs])
+        self._by_order = {b.order(): b for b in bs}
+        self._labels_by_order = {b.order(): b.label() for b in sorted(bs, key=lambda b: b.order())}
+
+        # the kernels locate pieces and branches by their edges alone, which is exact for [lo, hi) partitions only
+        self._contiguous = (half_open_contiguous([p.domain() for p in f._funcs]) and
+                            half_open_contiguous([b.domain() for b in self._sorted_bs]))
 
+        # the generated kernel picks the piece and the branch with the same comparisons, so they must coincide
+        if specialized and self._contiguous and np.array_equal(f._bounds, self._edges):
+            self._kernel = specialize(f._bounds, f._slopes, f._intercepts, self._orders)
+        else:
+            self._kernel = simulate
+
+    def iter(self, start: float, num_it: int):
+        self._values = np.empty(num_it)
+        self._itinerary = np.empty(num_it, dtype=np.int8)
+        if self._contiguous:
+            self._simulate(np.array([start], dtype=float), self._values.reshape(num_it, 1),
+                           self._itinerary.reshape(num_it, 1), False)
+        else:
+            self._iter_exact(start, self._values, self._itinerary)
+
+    def iter_batch(self, starts: np.ndarray, num_it: int, dtype=np.float64, parallel: bool = True):
+        """
+        Iterates all starting points at once.
+
+        :param starts: the starting points
+        :param num_it: the number of iterations
+        :param dtype: np.float64 or np.float32, the type of the values (np.float64 by default); float32 halves the
+            memory traffic, but errors double every round trip on the demo tree, so its itineraries diverge from
+            float64 ones after a few dozen steps
+        :param parallel: True if the starting points should be spread over Numba's threads, which needs its TBB or
+            OpenMP threading layer when called from several threads at once; False, otherwise (True by default)
+        :return: the values and the branch orders, both of shape (num_it, len(starts))
+        """
+        dtype = np.dtype(dtype)
+        if dtype != np.float32 and dtype != np.float64:
+            raise ValueError(f'Values must be of type np.float32 or np.float64, not {dtype}')
+
+        s = np.asarray(starts, dtype=dtype).ravel()
+        values = np.empty((num_it, s.size), dtype=dtype)
+        orders = np.empty((num_it, s.size), dtype=np.int8)
+        if self._contiguous:
+            self._simulate(s, values, orders, parallel)
+        else:
+            for j in range(s.size):
+                self._iter_exact(s[j], values[:, j], orders[:, j])
+        return values, orders
+
+    def _simulate(self, starts: np.ndarray, values: np.ndarray, orders: np.ndarray, parallel: bool):
+        # fills the preallocated (num_it, len(starts)) buffers in the precision of the starting points
+        dtype = starts.dtype
+        f = self._f
+        # the specialized kernel is parallel and has float64 constants baked in, so other runs take a generic one
+        if not parallel:
+            kernel = simulate_serial
+        elif dtype == np.float64:
+            kernel = self._kernel
+        else:
+            kernel = simulate
+        kernel(starts, f._bounds.astype(dtype, copy=False), f._slopes.astype(dtype, copy=False),
+               f._intercepts.astype(dtype, copy=False), self._edges.astype(dtype, copy=False),
+               self._orders, values, orders)
+
+        escaped = np.argwhere(orders < 0)
+        if escaped.size > 0:
+            t, j = escaped[0]
+            raise ValueError(f'Value {values[t, j]} does not lie in any branch or defined domain')
+
+    def _iter_exact(self, start: float, values: np.ndarray, orders: np.ndarray):
+        # steps with the full interval checks, for trees the kernels cannot represent
         s = start
-        for _ in range(num_it):
-            self._values.append(s)
-            self._itinerary.append(self.which_branch(s))
+        for t in range(values.size):
+            values[t] = s
+            orders[t] = self.which_branch(s).order()
             s = self._f(s)
 
     def which_branch(self, x: float) -> Branch:
-        for b in self._bs:
-            if x in b:
-                return b
+        k = bisect.bisect_right(self._lows, x) - 1
+        for i in (k, k - 1):  # x may sit on the excluded left bound of branch k
+            if 0 <= i < self._num_branches and x in self._sorted_bs[i]:
+                return self._sorted_bs[i]
         raise ValueError(f'Value {x} does not lie in any branch')  # reached if f is not surjective
 
     def values(self):
@@ -241,8 +368,12 @@ class Tree:
     def orders(self):
         return [m[1] for m in self._meta]
 
+    def labels_by_order(self):
+        return self._labels_by_order
+
     def itinerary(self):
-        return self._itinerary
+        # the branches are looked up from the stored orders on demand
+        return [self._by_order[k] for k in self._itinerary.tolist()]
 
     def __contains__(self, other: Branch):
         for b in self._bs:
@@ -264,6 +395,8 @@ class Tree:
 class Plotter:
     @staticmethod
     def plot(x_values, y_values, y_labels, start, period, ticks, labels):
+        import matplotlib.pyplot as plt  # imported lazily as it is only needed by the opt-in plotting
+
         fig, (ax1, ax2) = plt.subplots(2, sharex='all', figsize=(10, 6))
         fig.suptitle(f'Itinerary starting from {start}')
         fig.supxlabel('Steps')
@@ -0,0 +1,111 @@
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, nogil=True, fastmath={'contract'}, cache=True)
+def simulate(starts, bounds, slopes, intercepts, edges, orders, values_out, idx_out):
+    """
+    Iterates a piecewise linear map from every starting point in parallel.
+
+    Both the pieces and the branches are given by their sorted edges and must be of the form [lo, hi).
+    A trajectory that leaves them has its remaining orders set to -1.
+
+    Calling this from several threads at once needs Numba's TBB or OpenMP threading layer; the workqueue
+    layer it falls back to otherwise aborts the process. Use simulate_serial to split the work yourself.
+
+    :param starts: the starting points
+    :param bounds: the edges of the pieces
+    :param slopes: the slope of each piece
+    :param intercepts: the intercept of each piece
+    :param edges: the edges of the branches
+    :param orders: the order of each branch
+    :param values_out: the values, of shape (n_iter, len(starts))
+    :param idx_out: the branch orders, of shape (n_iter, len(starts))
+    """
+    for j in prange(starts.size):
+        _trajectory(j, starts, bounds, slopes, intercepts, edges, orders, values_out, idx_out)
+
+
+@njit(nogil=True, fastmath={'contract'}, cache=True)
+def simulate_serial(starts, bounds, slopes, intercepts, edges, orders, values_out, idx_out):
+    """
+    Iterates like simulate, but on the calling thread only, so it is safe to call from a thread pool.
+    """
+    for j in range(starts.size):
+        _trajectory(j, starts, bounds, slopes, intercepts, edges, orders, values_out, idx_out)
+
+
+@njit(nogil=True, fastmath={'contract'}, cache=True)
+def _trajectory(j, starts, bounds, slopes, intercepts, edges, orders, values_out, idx_out):
+    n_iter = values_out.shape[0]
+    n_pieces = slopes.size
+    n_branches = orders.size
+    s = starts[j]
+    for t in range(n_iter):
+        if not (bounds[0] <= s < bounds[n_pieces] and edges[0] <= s < edges[n_branches]):
+            values_out[t:, j] = s
+            idx_out[t:, j] = -1
+            break
+
+        # a linear scan beats a binary search for the handful of pieces a tree has
+        k = 0
+        while k + 1 < n_pieces and bounds[k + 1] <= s:
+            k += 1
+        b = 0
+        while b + 1 < n_branches and edges[b + 1] <= s:
+            b += 1
+
+        values_out[t, j] = s
+        idx_out[t, j] = orders[b]
+        s = slopes[k] * s + intercepts[k]
+
+
+_SPECIALIZED_TEMPLATE = '''
+def simulate_specialized(starts, bounds, slopes, intercepts, edges, orders, values_out, idx_out):
+    n_iter = values_out.shape[0]
+    for j in prange(starts.size):
+        s = starts[j]
+        for t in range(n_iter):
+            if not ({lo} <= s < {hi}):
+                values_out[t:, j] = s
+                idx_out[t:, j] = -1
+                break
+
+            values_out[t, j] = s
+{cases}
+'''
+
+_specialized = {}
+
+
+def specialize(bounds, slopes, intercepts, orders):
+    """
+    Generates a variant of simulate with the pieces of a tree inlined as straight-line code.
+
+    The pieces must coincide with the branches, i.e. piece k is branch k in order of their edges.
+    The generated kernel takes the same arguments as simulate but ignores the tree arrays.
+
+    :param bounds: the edges of the pieces (and branches)
+    :param slopes: the slope of each piece
+    :param intercepts: the intercept of each piece
+    :param orders: the order of each branch
+    :return: the compiled kernel
+    """
+    key = (tuple(bounds), tuple(slopes), tuple(intercepts), tuple(orders))
+    if key not in _specialized:
+        cases = []
+        for k in range(len(slopes)):
+            if k == len(slopes) - 1:
+                test = 'else:' if k > 0 else 'if True:'
+            else:
+                test = f'{"if" if k == 0 else "elif"} s < {float(bounds[k + 1])!r}:'
+            cases.append(f'            {test}\n'
+                         f'                idx_out[t, j] = {int(orders[k])}\n'
+                         f'                s = {float(slopes[k])!r} * s + {float(intercepts[k])!r}')
+        source = _SPECIALIZED_TEMPLATE.format(lo=repr(float(bounds[0])), hi=repr(float(bounds[-1])),
+                                              cases='\n'.join(cases))
+        namespace = {'prange': prange, 'inf': np.inf}
+        exec(source, namespace)
+        kernel = njit(parallel=True, nogil=True, fastmath={'contract'})
+        _specialized[key] = kernel(namespace['simulate_specialized'])
+    return _specialized[key]